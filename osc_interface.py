@@ -18,10 +18,32 @@ import usb.core
 import usb.util
 
 import json
+import re
 import time
 
 import numpy as np
 
+# orjson (optional) parses the JSON responses considerably faster
+try:
+    import orjson as _json
+except ImportError:
+    _json = json
+
+# non-JSON bytes contained in the response to a measurement query
+_MEAS_SENTINEL = re.compile(rb'0\x02\x00\x00')
+
+# numba (optional) fuses the ADC to voltage conversion into a single loop
+try:
+    from numba import njit
+except ImportError:
+    _scale_kernel = None
+else:
+    @njit(cache=True, fastmath=True)
+    def _scale_kernel(adc, factor, shift, out):
+        for k in range(adc.shape[0]):
+            out[k] = factor * (adc[k] - shift)
+        return out
+
 
 class Oscilloscope():
     ## Hanmatek DOS1102 vendor and product id:
@@ -32,10 +54,22 @@ class Oscilloscope():
     addr_OUT_HANMATEK_DOS1102 = 0x3
     # Bulk IN
     addr_IN_HANMATEK_DOS1102 = 0x81
+    ## unit suffixes used in the meta data and their factors, 
+    ## ordered longest-first so that e.g. 'V' cannot match inside 'mV'
+    _SI_SUFFIX = (('kS/s', 1e3), ('MS/s', 1e6), ('GS/s', 1e9))
+    _SCALE_SUFFIX = (('mV', 1e-3), ('kV', 1e3), ('mA', 1e-3), ('kA', 1e3),
+                     ('V', 1.0), ('A', 1.0))
 
     def __init__(self, idVendor : str = None, idProduct : str = None,
-                 addr_OUT : int = None, addr_IN : int = None, verbose = False):
+                 addr_OUT : int = None, addr_IN : int = None, verbose = False,
+                 read_chunk : int = 1 << 20,
+                 timeout_ms : int = 1000):
         self.verbose = verbose
+        self.set_chunk(read_chunk)
+        self.set_timeout(timeout_ms)
+        # output arrays of the waveform conversion, reused per channel and
+        # (re)allocated by decode_waveform_data when the length changes
+        self._wave_buf = {}
         if idVendor is None:
             self.idVendor = self.idVendor_HANMATEK_DOS1102
         else:
@@ -60,11 +94,91 @@ class Oscilloscope():
         if self.dev is None:
             raise ValueError('Oscilloscope not found')
         else:
+            self._claim_interface()
             if self.verbose:
                 print('Success, device found.')
                 print('Instrument ID: ', self.query_string_result('*IDN?'))
             self.meta_data = self.get_meta_data()
 
+    def _claim_interface(self) -> None:
+        '''
+        configure the device and claim its interface once, and look up the
+        bulk endpoints so transfers do not need to resolve them per call
+    
+        '''
+        self._kernel_driver_detached = False
+        try:
+            if self.dev.is_kernel_driver_active(0):
+                self.dev.detach_kernel_driver(0)
+                self._kernel_driver_detached = True
+        except NotImplementedError:
+            # not supported by the backend (e.g. libusb0 on Windows)
+            pass
+        self.dev.set_configuration()
+        cfg = self.dev.get_active_configuration()
+        self._intf = cfg[(0,0)]
+        usb.util.claim_interface(self.dev, self._intf)
+        
+        self._ep_in = usb.util.find_descriptor(
+            self._intf, bEndpointAddress=self.addr_IN)
+        self._ep_out = usb.util.find_descriptor(
+            self._intf, bEndpointAddress=self.addr_OUT)
+        if self._ep_in is None or self._ep_out is None:
+            raise ValueError('Bulk endpoints of the oscilloscope not found')
+
+    def close(self) -> None:
+        '''
+        release the interface claimed in __init__, give the device back to
+        its kernel driver if it was detached, and free the USB resources.
+        The object cannot be used for communication afterwards.
+
+        Returns
+        -------
+        None.
+
+        '''
+        usb.util.release_interface(self.dev, self._intf)
+        if self._kernel_driver_detached:
+            self.dev.attach_kernel_driver(0)
+            self._kernel_driver_detached = False
+        usb.util.dispose_resources(self.dev)
+
+    def set_timeout(self, ms : int) -> None:
+        '''
+        set the timeout of USB reads
+
+        Parameters
+        ----------
+        ms : int
+            timeout in milliseconds.
+
+        Returns
+        -------
+        None.
+
+        '''
+        self._timeout_ms = ms
+
+    def set_chunk(self, n : int) -> None:
+        '''
+        set the size of a single USB bulk read. It should be large enough to
+        hold a full response in one transfer.
+
+        Parameters
+        ----------
+        n : int
+            size in bytes, a multiple of 1024 (i.e. of the max packet size).
+
+        Returns
+        -------
+        None.
+
+        '''
+        if n <= 0 or n % 1024 != 0:
+            raise ValueError('Read chunk size must be a positive multiple '
+                             'of 1024')
+        self._read_chunk = n
+
     def write(self, msg : str | list) -> None:
         '''
         send command to oscilloscope without reading information back
@@ -96,16 +210,61 @@ class Oscilloscope():
             result as bytes.
 
         '''
-        if type(msg) == type(list()):
-            result = list()
-            for msgk in msg:
-                self.dev.write(self.addr_OUT,msgk)
-                result.append(self.dev.read(self.addr_IN,100000,1000))
+        if isinstance(msg, list):
+            result = [None]*len(msg)
+            w = self._ep_out.write
+            r = self._read_response
+            for k, msgk in enumerate(msg):
+                w(msgk)
+                result[k] = r()
         else: 
-            self.dev.write(self.addr_OUT,msg)            
-            result = (self.dev.read(self.addr_IN,100000,1000))
+            self._ep_out.write(msg)            
+            result = self._read_response()
+        return result
+    
+    def _read_response(self) -> list:
+        '''
+        read one response. A bulk transfer ends with a short packet, so 
+        reading only continues if a read has filled the whole buffer, i.e.
+        if the response is larger than the read chunk size.
+        
+        '''
+        r = self._ep_in.read
+        result = chunk = r(self._read_chunk,self._timeout_ms)
+        while len(chunk) == self._read_chunk:
+            try:
+                chunk = r(self._read_chunk,self._timeout_ms)
+            except usb.core.USBTimeoutError:
+                # the response was an exact multiple of the chunk size
+                break
+            result += chunk
         return result
     
+    def pipeline(self, cmds : list) -> list:
+        '''
+        send several commands at once: all messages are written first and
+        the responses are read afterwards, so the commands do not wait for
+        each other's round trip. In contrast, query with a list waits for
+        the response to each message before writing the next one, which 
+        also works for commands whose response must be read before the 
+        next command is accepted.
+        
+        Parameters
+        ----------
+        cmds : list (of str)
+            messages to be transmitted to the oscilloscope.
+
+        Returns
+        -------
+        list
+            results as bytes, in the order of cmds.
+
+        '''
+        for cmd in cmds:
+            self._ep_out.write(cmd)
+        r = self._read_response
+        return [r() for _ in cmds]
+    
     def query_and_show_response(self, msg:str) -> None:
         '''
         send a query to the oscilloscope and display the answer directly.
@@ -122,11 +281,8 @@ class Oscilloscope():
     
         '''
         result = self.query(msg)
-        try:
-            string = result.tobytes().decode('utf-8')
-        except:
-            res = [str(rk) for rk in result]
-            string = ' '.join(res)
+        # binary responses show up with replacement characters
+        string = bytes(result).decode('utf-8', errors='replace')
         print(string)
     
     def query_string_result(self, msg : str | list) -> str | list:
@@ -145,21 +301,28 @@ class Oscilloscope():
     
         '''
         result = self.query(msg)
-        if type(result) == type(list()):
+        if isinstance(result, list):
             result = [resk.tobytes().decode('utf-8') for resk in result]
         else:
             result = result.tobytes().decode('utf-8')
         return result  
     
-    def get_channel_waveform_data(self, ch:int) -> np.array:
+    def get_channel_waveform_data(self, ch:int,
+                                  refresh_meta : bool = False) -> np.array:
         '''
         Queries the data recorded on channel ch and returns it in an np.array.
         The data is scaled to the voltage at the probe input.
+        The returned array is a read-only view of a buffer that is reused by 
+        the next fetch of the same channel; copy it if it needs to be kept.
 
         Parameters
         ----------
         ch : int
             channel number (1 or 2).
+        refresh_meta : bool, optional
+            re-read the meta data before fetching. Only needed if the 
+            settings of the oscilloscope may have changed since the last 
+            call of get_meta_data. The default is False.
 
         Returns
         -------
@@ -167,28 +330,74 @@ class Oscilloscope():
             data.
 
         '''
-        self.get_meta_data()
+        if refresh_meta:
+            self.get_meta_data()
         raw_data = self.query(f':DATA:WAVE:SCREEN:CH{ch}?')
-        data = []
-        # discard first 4 bytes (meta data)
-        for idx in range(4,len(raw_data),2):
-            # two bytes at a time 
-            # -> one signed integer (little-endian byte order)
-            adc_val = int().from_bytes([raw_data[idx], raw_data[idx+1]],
-                                       'little', signed=True)
-            # adc_val /= 4096
-            data.append(adc_val)
-        
-        # offset and scaling
-        offset = int(self.meta_data['CHANNEL'][ch-1]['OFFSET'])
+        return self.decode_waveform_data(raw_data, ch)
+    
+    def get_both_channels(self, refresh_meta : bool = False) -> tuple:
+        '''
+        Queries the data recorded on both channels in one go. The data is 
+        scaled to the voltage at the probe input.
+
+        Parameters
+        ----------
+        refresh_meta : bool, optional
+            re-read the meta data before fetching. Only needed if the 
+            settings of the oscilloscope may have changed since the last 
+            call of get_meta_data. The default is False.
+
+        Returns
+        -------
+        tuple (of np.array)
+            data of channel 1 and channel 2.
+
+        '''
+        if refresh_meta:
+            self.get_meta_data()
+        raw_data = self.query([':DATA:WAVE:SCREEN:CH1?',
+                               ':DATA:WAVE:SCREEN:CH2?'])
+        return tuple(self.decode_waveform_data(raw_datak, ch) 
+                     for ch, raw_datak in enumerate(raw_data, start=1))
+    
+    def decode_waveform_data(self, raw_data, ch:int) -> np.array:
+        '''
+        convert the raw response of a waveform query, e.g. obtained through
+        pipeline, to the voltage at the probe input of channel ch
+
+        Parameters
+        ----------
+        raw_data : list
+            response to ':DATA:WAVE:SCREEN:CHx?' as bytes.
+        ch : int
+            channel number (1 or 2).
+
+        Returns
+        -------
+        np.array
+            data.
+
+        '''
+        # discard first 4 bytes (meta data), then interpret two bytes at a
+        # time as one signed integer (little-endian byte order)
+        adc_data = np.frombuffer(bytes(raw_data)[4:], dtype='<i2')
         
-        scale = self.get_scale(ch)
+        # offset and scaling, precomputed by _rebuild_cal
+        scale, offset, a, b = self._cal[ch-1]
+        out = self._wave_buf.get(ch)
+        if out is None or out.shape != adc_data.shape:
+            out = np.empty(adc_data.shape, dtype=np.float64)
+            self._wave_buf[ch] = out
+        if _scale_kernel is None:
+            np.subtract(adc_data, offset*a, out=out)
+            np.multiply(out, scale/b, out=out)
+        else:
+            _scale_kernel(adc_data, scale/b, offset*a, out)
         
-        # It seems that per division, there are 410 points
-        # and 8.25 offset points per ADC value... highly confusing
-        data = [scale * (dk - offset*8.25)/410 for dk in data]
-            
-        return np.array(data,dtype=np.float64)
+        # read-only view, so callers cannot modify the reused buffer
+        data = out.view()
+        data.flags.writeable = False
+        return data
     
     def get_channel_measurement_data(self, ch:int) -> dict:
         '''
@@ -208,9 +417,9 @@ class Oscilloscope():
             all measurements in dict format.
         
         '''
-        meas_string = self.query_string_result(f':MEAS:CH{ch}?')
-        meas_string = meas_string.replace('0\x02\x00\x00', '')
-        return json.loads(meas_string)
+        meas_data = self.query(f':MEAS:CH{ch}?')
+        meas_data = _MEAS_SENTINEL.sub(b'', bytes(meas_data))
+        return _json.loads(meas_data)
 
     def get_meta_data(self) -> None:
         '''
@@ -224,11 +433,45 @@ class Oscilloscope():
     
         '''
         meta_data = self.query(':DATA:WAVE:SCREen:HEAD?')
-        meta_data = meta_data[4:].tobytes().decode('utf-8')
+        return self.parse_meta_data(meta_data)
+    
+    def parse_meta_data(self, raw_data) -> dict:
+        '''
+        parse the raw response of a meta data query, e.g. obtained through
+        pipeline, and save it to object property
+    
+        Parameters
+        ----------
+        raw_data : list
+            response to ':DATA:WAVE:SCREen:HEAD?' as bytes.
+    
+        Returns
+        -------
+        meta_data : dict
+            contains the meta data of the recording.
+    
+        '''
+        # both parsers accept bytes directly
+        meta_data = memoryview(raw_data)[4:].tobytes()
         
-        self.meta_data = json.loads(meta_data)
+        self.meta_data = _json.loads(meta_data)
+        self._rebuild_cal()
         return self.meta_data
     
+    def _rebuild_cal(self) -> None:
+        '''
+        precompute the calibration of each channel from the meta data, so 
+        the waveform conversion does not need to parse it for every fetch.
+        Per channel, (scale, offset, a, b) is stored where the voltage is 
+        (scale/b) * (adc_value - offset*a).
+    
+        '''
+        # It seems that per division, there are 410 points
+        # and 8.25 offset points per ADC value... highly confusing
+        self._cal = [(self.get_scale(ch), int(chk['OFFSET']), 8.25, 410.0)
+                     for ch, chk in enumerate(self.meta_data['CHANNEL'], 
+                                              start=1)]
+    
     def get_sample_rate(self) -> float:
         '''
         extract sample rate info from meta data. The sample rate is global
@@ -243,19 +486,20 @@ class Oscilloscope():
             sample rate.
     
         '''
-        sample_rate = self.meta_data['SAMPLE']['SAMPLERATE']
-        sample_rate = sample_rate.replace('(','')
-        sample_rate = sample_rate.replace(')','')
-        
-        possible_units = ['kS/s','MS/s','GS/s']
-        ten_exp = [3,6,9]
-        
-        for k, unit in enumerate(possible_units):
-            if unit in sample_rate:
-                break;
-        
-        sample_rate = float(sample_rate.replace(unit,'')) * 10**ten_exp[k]
-        return sample_rate
+        sample_rate = self.meta_data['SAMPLE']['SAMPLERATE'].strip('()')
+        return self._parse_suffixed(sample_rate, self._SI_SUFFIX)
+
+    @staticmethod
+    def _parse_suffixed(s : str, suffixes : tuple) -> float:
+        '''
+        convert a value with unit suffix (e.g. '500mV') to a float in SI 
+        base units
+    
+        '''
+        for suf, mul in suffixes:
+            if s.endswith(suf):
+                return float(s[:-len(suf)]) * mul
+        raise ValueError(f'Unknown unit in {s!r}')
 
     def get_scale(self, ch) -> float:
         '''
@@ -272,31 +516,30 @@ class Oscilloscope():
         '''
         scale = self.meta_data['CHANNEL'][ch-1]['SCALE']
         
-        possible_units = ['mV','V', 'kV',
-                          'mA', 'A', 'kA']
-        ten_exp = [-3,0,3,
-                   -3,0,3]
-        
-        for k, unit in enumerate(possible_units):
-            if unit in scale:
-                break;
-        
-        scale = float(scale.replace(unit,'')) * 10**ten_exp[k]
+        scale = self._parse_suffixed(scale, self._SCALE_SUFFIX)
         probe_attenuation = \
             int(self.meta_data['CHANNEL'][ch-1]['PROBE'].replace('X',''))
         return scale*probe_attenuation
 
-    def get_time_base(self) -> np.array:
+    def get_time_base(self, refresh_meta : bool = False) -> np.array:
         '''
         synthesize the time array of the current recording
 
+        Parameters
+        ----------
+        refresh_meta : bool, optional
+            re-read the meta data before synthesizing. Only needed if the 
+            settings of the oscilloscope may have changed since the last 
+            call of get_meta_data. The default is False.
+
         Returns
         -------
         time_array : TYPE
             DESCRIPTION.
 
         '''
-        self.get_meta_data()
+        if refresh_meta:
+            self.get_meta_data()
         nbr_points = self.meta_data['SAMPLE']['DATALEN']
         
         sample_rate = self.get_sample_rate()
@@ -305,9 +548,8 @@ class Oscilloscope():
         offset = self.meta_data['TIMEBASE']['HOFFSET']
         time_offset = -1 * offset * 2 * sample_time
         
-        time_array = [(k-nbr_points/2)*sample_time - time_offset
-                      for k in range(nbr_points)]
-        time_array = np.array(time_array)
+        time_array = (np.arange(nbr_points, dtype=np.float64) - nbr_points/2) \
+            * sample_time - time_offset
         return time_array
 
     
@@ -315,10 +557,13 @@ if __name__ == '__main__':
     osci = Oscilloscope()
     osci.write(':RUNNING RUN')
     time.sleep(0.01)
-    osci.write(':RUNNING STOP')    
-    osci.get_meta_data()
+    _, meta_data, raw_ch1, raw_ch2 = osci.pipeline([':RUNNING STOP',
+                                                   ':DATA:WAVE:SCREen:HEAD?',
+                                                   ':DATA:WAVE:SCREEN:CH1?',
+                                                   ':DATA:WAVE:SCREEN:CH2?'])
+    osci.parse_meta_data(meta_data)
     time = osci.get_time_base()
-    data_ch1 = osci.get_channel_waveform_data(ch=1)
+    data_ch1 = osci.decode_waveform_data(raw_ch1, ch=1)
 
     # filter for nicer waveform (bandwidth loss assumed acceptable)
     from scipy.ndimage import gaussian_filter1d
@@ -337,22 +582,16 @@ if __name__ == '__main__':
 
     # save to disk
     import pandas as pd
-    data_ch2 = gaussian_filter1d(osci.get_channel_waveform_data(ch=2), sigma=1) 
+    data_ch2 = gaussian_filter1d(osci.decode_waveform_data(raw_ch2, ch=2),
+                                 sigma=1) 
     time *= 1E-6
-    data = np.array([time, data_ch1, data_ch2], dtype=np.float64).T
-    df = pd.DataFrame(data)
-    df.columns =  ['Time','CH1','CH2']
+    df = pd.DataFrame({'Time': time, 'CH1': data_ch1, 'CH2': data_ch2})
     df.to_csv('OsciData.csv', index=False)
     
-    meta_data_string = json.dumps(osci.meta_data)
-    measurement_data_ch1_string = \
-        json.dumps(osci.get_channel_measurement_data(ch=1))
-    measurement_data_ch2_string = \
-        json.dumps(osci.get_channel_measurement_data(ch=2))
-    
-    meta_meas_data_string = (meta_data_string + measurement_data_ch1_string + \
-        measurement_data_ch2_string).replace('}{', ',')
+    meta_meas_data = {**osci.meta_data,
+                      **osci.get_channel_measurement_data(ch=1),
+                      **osci.get_channel_measurement_data(ch=2)}
+    osci.close()
     
     with open("OsciData_MetaMeas.json",'w+') as file:
-        file.write(meta_meas_data_string)
-        file.close()
+        json.dump(meta_meas_data, file)